@@ -2,23 +2,29 @@
 # main.py - Calm Loop uploader (fixed overlay + robust ffmpeg handling)
 # Usage: python3 main.py --type shorts|long|very_long
 
-import os, sys, time, random, re, subprocess, requests, json, math
+import os, sys, time, random, re, errno, socket, subprocess, shutil, functools, hashlib, queue, threading, requests, json, math, csv
 from pathlib import Path
+from operator import itemgetter
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ------------- CONFIG -------------
 CHANNEL_HANDLE = "CalmLoop-l6p"
-TOPICS = [
+TOPICS = (
     "relaxing","rain","ocean","forest","waterfall","snow","clouds","desert night",
     "mountain","river","calm beach","winter cozy","campfire","underwater diving","birds",
     "sunset","sunrise","drone aerial","night stars","beach","misty forest"
-]
+)
 TITLE_TEMPLATES = {
-    "shorts": ["Instant Calm — {}", "{} Mini Escape", "{} Moment to Breathe", "Relax in seconds: {}"],
-    "long": ["{} Ambience for Relaxation & Focus", "Soothing {} Sounds — Relax & Sleep", "Peaceful {} Ambience — Calm Your Mind"],
-    "very_long": ["Extended {} Mix — Overnight Relaxation", "{} Soundscape — Sleep & Deep Rest"]
+    "shorts": ("Instant Calm — {}", "{} Mini Escape", "{} Moment to Breathe", "Relax in seconds: {}"),
+    "long": ("{} Ambience for Relaxation & Focus", "Soothing {} Sounds — Relax & Sleep", "Peaceful {} Ambience — Calm Your Mind"),
+    "very_long": ("Extended {} Mix — Overnight Relaxation", "{} Soundscape — Sleep & Deep Rest")
 }
 DESCRIPTION_TEMPLATE = "Calm Loop brings high-quality relaxing ambient sounds and nature visuals to help you relax, sleep, meditate, and focus."
-TAGS_BASE = ["relaxing","nature","sleep","meditation","ambient","calm","relax","soothing","ASMR","english"]
+TAGS_BASE = ("relaxing","nature","sleep","meditation","ambient","calm","relax","soothing","ASMR","english")
+TITLE_EMOJI = {"Rain":"🌧️","Ocean":"🌊","Forest":"🌿","Waterfall":"💧","Snow":"❄️","Clouds":"☁️","Underwater Diving":"🤿","Birds":"🐦"}
 
 # ------------- SECRETS / ENV -------------
 def env_int(name, default):
@@ -42,8 +48,18 @@ LONG_MIN_S = env_int("LONG_MIN_S", 120)           # >= 2 minutes
 LONG_MAX_S = env_int("LONG_MAX_S", 1800)          # <= 30 minutes
 VERY_LONG_MIN_S = env_int("VERY_LONG_MIN_S", 3600) # >= 1 hour
 AUDIO_MIN_DB = float(os.environ.get("AUDIO_MIN_DB","-60.0"))
+AUDIO_SAMPLE_S = env_int("AUDIO_SAMPLE_S", 5)     # per-window length for audio gating on long files
 MAX_CANDIDATES = env_int("MAX_CANDIDATES", 18)
 TRY_COUNT = env_int("TRY_COUNT", 10)
+MAX_DOWNLOADS = env_int("MAX_DOWNLOADS", 8)       # usable clips kept per attempt
+DOWNLOAD_WORKERS = env_int("DOWNLOAD_WORKERS", 8)
+MAX_CLIP_BYTES = env_int("MAX_CLIP_BYTES", 300*1024*1024)
+MIN_CLIP_BYTES = env_int("MIN_CLIP_BYTES", 500_000)
+MAX_POOL_BYTES = env_int("MAX_POOL_BYTES", 3*1024*1024*1024)  # long builds' clip pool on disk
+# cores this process may actually run on (containers often expose every host core)
+CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+X264_THREADS = env_int("X264_THREADS", 4)          # avoid oversubscribing shared runners
+ENCODE_WORKERS = env_int("ENCODE_WORKERS", max(1, CPUS // X264_THREADS))
 
 # ------------- PATHS -------------
 ROOT = Path(".").resolve()
@@ -58,11 +74,84 @@ UPLOAD_LOG = ROOT / "uploads_log.csv"
 REQ_HEADERS = {"User-Agent":"Mozilla/5.0"}
 REQ_TIMEOUT = 45
 
+def make_session(retry_methods=Retry.DEFAULT_ALLOWED_METHODS):
+    # pooled keep-alive session; SESSION serves every searcher, download and token call
+    s = requests.Session()
+    s.headers.update(REQ_HEADERS)
+    # transient 429/5xx are retried with backoff; after that callers see the last response
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429,500,502,503,504],
+                  allowed_methods=retry_methods, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+SESSION = make_session()
+# resumable upload PUTs: upload_chunks resumes from the server's offset with its own backoff,
+# so the adapter must hand 5xx straight back instead of resending the chunk blindly
+UPLOAD_SESSION = make_session(Retry.DEFAULT_ALLOWED_METHODS - {"PUT"})
+
+API_HOSTS = ("api.pexels.com", "pixabay.com", "api.coverr.co", "archive.org",
+             "oauth2.googleapis.com", "www.googleapis.com", "www.soundhelix.com")
+
+def prefetch_dns(hosts=API_HOSTS):
+    # warm the system resolver cache in the background; failures just mean a cold lookup later
+    def resolve(host):
+        try: socket.getaddrinfo(host, 443, type=socket.SOCK_STREAM)
+        except OSError: pass
+    for host in hosts:
+        threading.Thread(target=resolve, args=(host,), daemon=True).start()
+
 # ------------- UTIL -------------
-def sh(cmd, capture=False):
-    if capture:
-        return subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).decode('utf-8', errors='ignore')
-    return subprocess.check_call(cmd, shell=True)
+MEAN_VOL_RE = re.compile(r'mean_volume:\s*([-0-9\.]+)\s*dB')
+
+# worker threads may tag their sh() calls (SH_GROUP.tag) so the whole job can be killed at once
+SH_GROUP = threading.local()
+SH_LOCK = threading.Lock()
+GROUP_PROCS = {}   # tag -> running Popen objects
+CANCELLED = set()  # tags whose jobs must not start new processes
+
+class CommandError(subprocess.CalledProcessError):
+    # captured runs hide ffmpeg's console output; keep its tail in the message for the CI log
+    def __str__(self):
+        tail = (self.output or b"").decode("utf-8", errors="ignore").strip().splitlines()[-15:]
+        return "\n".join([super().__str__(), *tail])
+
+def sh(argv, capture=False):
+    # argv list, no /bin/sh in between: no quoting, paths with spaces/quotes are safe
+    # stdin=DEVNULL: concurrent ffmpeg workers must not fight over the terminal
+    argv = [str(a) for a in argv]
+    tag = getattr(SH_GROUP, "tag", None)
+    with SH_LOCK:
+        if tag in CANCELLED:
+            raise RuntimeError(f"cancelled: {argv[0]}")
+        proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE if capture else None,
+                                stderr=subprocess.STDOUT if capture else None)
+        if tag is not None: GROUP_PROCS.setdefault(tag, set()).add(proc)
+    try:
+        out, _ = proc.communicate()
+    finally:
+        if tag is not None:
+            with SH_LOCK: GROUP_PROCS.get(tag, set()).discard(proc)
+    if proc.returncode:
+        raise CommandError(proc.returncode, argv, out)
+    return out.decode('utf-8', errors='ignore') if capture else 0
+
+def run_tagged(tag, fn, *args):
+    SH_GROUP.tag = tag
+    try:
+        return fn(*args)
+    finally:
+        SH_GROUP.tag = None
+
+def cancel_group(tag):
+    """Kill every process started under tag and refuse new ones."""
+    with SH_LOCK:
+        CANCELLED.add(tag)
+        procs = GROUP_PROCS.pop(tag, set())
+    for proc in procs:
+        proc.kill()
 
 def ensure_dirs():
     WORK.mkdir(parents=True, exist_ok=True)
@@ -70,24 +159,77 @@ def ensure_dirs():
     OUT.mkdir(parents=True, exist_ok=True)
     ASSETS.mkdir(parents=True, exist_ok=True)
 
+def reset_dir(d):
+    shutil.rmtree(d, ignore_errors=True)
+    d.mkdir(parents=True, exist_ok=True)
+
+PROBE_CACHE = {}
+
+def probe_cached(fn):
+    """Memoize a probe per (path, mtime, size) so an unchanged file is only probed once."""
+    @functools.wraps(fn)
+    def wrapper(p, *args):
+        try:
+            st = os.stat(p)
+        except OSError:
+            return fn(p, *args)
+        key = (fn.__name__, str(p), st.st_mtime_ns, st.st_size) + args
+        if key not in PROBE_CACHE:
+            PROBE_CACHE[key] = fn(p, *args)
+        return PROBE_CACHE[key]
+    return wrapper
+
+def seed_probe(fn, p, value, *args):
+    # record a result we already know (e.g. measured during an encode) for a probe_cached fn
+    try:
+        st = os.stat(p)
+    except OSError:
+        return
+    PROBE_CACHE[(fn.__name__, str(p), st.st_mtime_ns, st.st_size) + args] = value
+
+def move_probes(src, dst):
+    # a rename keeps content, mtime and size: carry src's cached results over to dst
+    try:
+        st = os.stat(dst)
+    except OSError:
+        return
+    for key in [k for k in PROBE_CACHE if k[1] == str(src) and k[2:4] == (st.st_mtime_ns, st.st_size)]:
+        PROBE_CACHE[(key[0], str(dst)) + key[2:]] = PROBE_CACHE.pop(key)
+
+@probe_cached
 def ffprobe_duration(p):
     try:
-        out = sh(f'ffprobe -v error -show_entries format=duration -of csv=p=0 "{p}"', capture=True).strip()
+        out = sh(["ffprobe","-v","error","-show_entries","format=duration","-of","csv=p=0",p], capture=True).strip()
         return float(out) if out else 0.0
     except Exception:
         return 0.0
 
+@probe_cached
 def has_audio_stream(p):
     try:
-        out = sh(f'ffprobe -v error -select_streams a -show_entries stream=codec_type -of csv=p=0 "{p}"', capture=True)
+        out = sh(["ffprobe","-v","error","-select_streams","a","-show_entries","stream=codec_type","-of","csv=p=0",p], capture=True)
         return bool(out.strip())
     except Exception:
         return False
 
-def audio_mean_db(p):
+@probe_cached
+def audio_mean_db(p, window_s=AUDIO_SAMPLE_S):
+    """
+    Mean volume of p. Long files are only sampled: window_s seconds at the start,
+    middle and end are concatenated and measured, so a 3 h video costs a few
+    seconds of decode while a silent head or tail still drags the mean down.
+    """
     try:
-        out = sh(f'ffmpeg -hide_banner -nostats -i "{p}" -af volumedetect -f null /dev/null', capture=True)
-        m = re.search(r'mean_volume:\s*([-0-9\.]+)\s*dB', out)
+        dur = ffprobe_duration(p)
+        if dur <= 6 * window_s:
+            argv = ["ffmpeg","-hide_banner","-nostats","-i",p,"-map","0:a:0","-af","volumedetect","-f","null","-"]
+        else:
+            argv = ["ffmpeg","-hide_banner","-nostats"]
+            for start in (0, dur/2 - window_s/2, dur - 2*window_s):
+                argv += ["-ss",f"{start:.2f}","-t",window_s,"-i",p]
+            argv += ["-filter_complex","[0:a:0][1:a:0][2:a:0]concat=n=3:v=0:a=1,volumedetect","-f","null","-"]
+        out = sh(argv, capture=True)
+        m = MEAN_VOL_RE.search(out)
         return float(m.group(1)) if m else None
     except Exception:
         return None
@@ -99,29 +241,119 @@ def audio_ok(p, min_db=AUDIO_MIN_DB):
     if mv is None: return False
     return mv > min_db
 
+def first_codecs(streams):
+    first = lambda kind: next((st.get("codec_name") for st in streams if st.get("codec_type") == kind), None)
+    return first("video"), first("audio")
+
+@probe_cached
+def stream_codecs(p):
+    """(video codec, audio codec) of the first streams, None where absent."""
+    try:
+        meta = json.loads(sh(["ffprobe","-v","error","-print_format","json","-show_entries","stream=codec_type,codec_name",p], capture=True))
+        return first_codecs(meta.get("streams",[]))
+    except Exception:
+        return None, None
+
+@probe_cached
+def probe_clip(p, silence_db=-50, silence_s=2.0):
+    """
+    One ffprobe for duration + audio presence, then (if there is audio) one ffmpeg
+    audio-only decode running volumedetect and silencedetect together.
+    """
+    info = {"duration": 0.0, "has_audio": False, "mean_db": None, "has_silence": True}
+    try:
+        meta = json.loads(sh(["ffprobe","-v","error","-print_format","json","-show_format","-show_streams",p], capture=True))
+        info["duration"] = float(meta.get("format",{}).get("duration") or 0.0)
+        info["has_audio"] = any(st.get("codec_type") == "audio" for st in meta.get("streams",[]))
+        # the single-field probes are answered by this one too
+        seed_probe(ffprobe_duration, p, info["duration"])
+        seed_probe(has_audio_stream, p, info["has_audio"])
+        seed_probe(stream_codecs, p, first_codecs(meta.get("streams",[])))
+    except Exception:
+        return info
+    if info["has_audio"]:
+        try:
+            out = sh(["ffmpeg","-hide_banner","-nostats","-i",p,"-map","0:a:0","-af",f"volumedetect,silencedetect=noise={silence_db}dB:d={silence_s}","-f","null","-"], capture=True)
+            m = MEAN_VOL_RE.search(out)
+            info["mean_db"] = float(m.group(1)) if m else None
+            info["has_silence"] = "silence_start" in out or "silence_end" in out
+        except Exception:
+            pass
+    return info
+
 def download_url(path, url, headers=None, timeout=REQ_TIMEOUT):
-    headers = headers or REQ_HEADERS
     print(f"[DL] {url} -> {path}")
-    r = requests.get(url, headers=headers, stream=True, timeout=timeout)
-    r.raise_for_status()
-    with open(path, "wb") as f:
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+    with SESSION.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with open(path, "wb") as f:
+            shutil.copyfileobj(r.raw, f, length=1024*1024)
     return path
 
+def preflight_clip(url, max_bytes=MAX_CLIP_BYTES, min_bytes=MIN_CLIP_BYTES):
+    """
+    HEAD the url and raise ValueError if it is clearly not worth downloading
+    (too big, too small, or not a video). Returns Content-Length (0 if unknown);
+    servers that refuse HEAD are let through.
+    """
+    try:
+        h = SESSION.head(url, allow_redirects=True, timeout=10)
+    except Exception:
+        return 0
+    if h.status_code >= 400: return 0
+    size = int(h.headers.get("Content-Length") or 0)
+    ctype = h.headers.get("Content-Type","").split(";")[0].strip().lower()
+    if size > max_bytes or 0 < size < min_bytes:
+        raise ValueError(f"skip {url}: {size} bytes outside {min_bytes}..{max_bytes}")
+    if ctype and not (ctype.startswith("video/") or ctype.endswith("octet-stream")):
+        raise ValueError(f"skip {url}: content-type {ctype}")
+    return size
+
 # ------------- SEARCH (Pexels, Pixabay, Coverr, Archive) -------------
+SEARCH_CACHE_FILE = WORK / ".search_cache.json"
+SEARCH_CACHE_TTL = 6 * 3600
+
+def read_search_cache():
+    """
+    Persisted {topic: {"at": epoch, "urls": [...]}} minus expired entries. A file
+    of any other shape (hand edit, older format) just counts as empty entries.
+    """
+    try:
+        data = json.loads(SEARCH_CACHE_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict): return {}
+    now = time.time()
+    return {t: e for t, e in data.items()
+            if isinstance(e, dict) and isinstance(e.get("at"), (int, float)) and isinstance(e.get("urls"), list)
+            and all(isinstance(u, str) for u in e["urls"]) and now - e["at"] < SEARCH_CACHE_TTL}
+
+def store_search_cache(topic, urls):
+    data = read_search_cache()
+    data[topic] = {"at": time.time(), "urls": urls}
+    try:
+        SEARCH_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = SEARCH_CACHE_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, SEARCH_CACHE_FILE)
+    except OSError as e:
+        print("search cache write failed", e)
+
+# topic -> urls returned by the searchers, seeded from runs in the last SEARCH_CACHE_TTL
+SEARCH_CACHE = {t: e["urls"] for t, e in read_search_cache().items()}
+TRIED_URLS = set()  # urls already downloaded by an earlier (failed) attempt
+
 def search_pexels(q, per_page=8):
     if not PEXELS_API_KEY: return []
     try:
-        r = requests.get("https://api.pexels.com/videos/search", headers={**REQ_HEADERS,"Authorization":PEXELS_API_KEY}, params={"query":q,"per_page":per_page}, timeout=REQ_TIMEOUT)
+        r = SESSION.get("https://api.pexels.com/videos/search", headers={"Authorization":PEXELS_API_KEY}, params={"query":q,"per_page":per_page}, timeout=REQ_TIMEOUT)
         if r.status_code != 200: return []
         data = r.json()
         out=[]
         for v in data.get("videos",[]):
             files = v.get("video_files",[])
             if files:
-                best = sorted(files, key=lambda x:(int(x.get("width",0)), int(x.get("height",0))), reverse=True)[0]
+                best = max(files, key=lambda x:(int(x.get("width",0) or 0), int(x.get("height",0) or 0)))
                 if best.get("link"): out.append(best.get("link"))
         return out
     except Exception as e:
@@ -130,7 +362,7 @@ def search_pexels(q, per_page=8):
 def search_pixabay(q, per_page=8):
     if not PIXABAY_API_KEY: return []
     try:
-        r = requests.get("https://pixabay.com/api/videos/", params={"key":PIXABAY_API_KEY,"q":q,"per_page":per_page}, headers=REQ_HEADERS, timeout=REQ_TIMEOUT)
+        r = SESSION.get("https://pixabay.com/api/videos/", params={"key":PIXABAY_API_KEY,"q":q,"per_page":per_page}, timeout=REQ_TIMEOUT)
         if r.status_code != 200: return []
         data = r.json()
         out=[]
@@ -146,7 +378,7 @@ def search_pixabay(q, per_page=8):
 def search_coverr(q=None):
     if not COVERR_API_KEY: return []
     try:
-        r = requests.get("https://api.coverr.co/videos", headers={**REQ_HEADERS, "Authorization":f"Bearer {COVERR_API_KEY}"}, timeout=REQ_TIMEOUT)
+        r = SESSION.get("https://api.coverr.co/videos", headers={"Authorization":f"Bearer {COVERR_API_KEY}"}, timeout=REQ_TIMEOUT)
         if r.status_code != 200: return []
         data = r.json()
         out=[]
@@ -157,71 +389,274 @@ def search_coverr(q=None):
     except Exception as e:
         print("coverr error", e); return []
 
+def archive_files(idv):
+    m = SESSION.get(f"https://archive.org/metadata/{idv}", timeout=REQ_TIMEOUT)
+    if m.status_code != 200: return []
+    out=[]
+    for f in m.json().get("files",[]):
+        name = f.get("name","")
+        if name.endswith(".mp4") or name.endswith(".m4v"):
+            out.append(f"https://archive.org/download/{idv}/{name}")
+    return out
+
 def search_archive(q, rows=6):
     try:
         qenc = requests.utils.quote(f'("{q}" OR {" ".join(q.split())})')
         url = f"https://archive.org/advancedsearch.php?q={qenc}&fl[]=identifier&rows={rows}&output=json"
-        r = requests.get(url, headers=REQ_HEADERS, timeout=REQ_TIMEOUT)
+        r = SESSION.get(url, timeout=REQ_TIMEOUT)
         if r.status_code != 200: return []
         ids = [d.get("identifier") for d in r.json().get("response",{}).get("docs",[])]
         out=[]
-        for idv in ids:
-            m = requests.get(f"https://archive.org/metadata/{idv}", headers=REQ_HEADERS, timeout=REQ_TIMEOUT)
-            if m.status_code != 200: continue
-            meta = m.json()
-            for f in meta.get("files",[]):
-                name = f.get("name","")
-                if name.endswith(".mp4") or name.endswith(".m4v"):
-                    out.append(f"https://archive.org/download/{idv}/{name}")
+        # metadata lookups fan out in parallel; stop as soon as enough files are found
+        ex = ThreadPoolExecutor(max_workers=8)
+        futures = [ex.submit(archive_files, idv) for idv in ids if idv]
+        for fut in as_completed(futures):
+            try:
+                out += fut.result()
+            except Exception as e:
+                print("archive metadata error", e)
             if len(out) >= rows: break
+        ex.shutdown(wait=False, cancel_futures=True)
         return out
     except Exception as e:
         print("archive error", e); return []
 
-def gather_candidates(topic):
-    urls = []
-    urls += search_pexels(topic, per_page=6)
-    urls += search_pixabay(topic, per_page=6)
-    urls += search_coverr(topic)
-    urls += search_archive(topic, rows=6)
-    random.shuffle(urls)
-    return urls[:MAX_CANDIDATES]
+def candidate_batches(topic):
+    """
+    Yield shuffled batches of untried urls for topic: one batch from SEARCH_CACHE,
+    or one per searcher as each returns so downloads can start early.
+    """
+    if topic in SEARCH_CACHE:
+        urls = [u for u in SEARCH_CACHE[topic] if u not in TRIED_URLS]
+        random.shuffle(urls)
+        yield urls
+        return
+    searches = [(search_pexels, (topic, 6)), (search_pixabay, (topic, 6)), (search_coverr, (topic,)), (search_archive, (topic, 6))]
+    found = []
+    with ThreadPoolExecutor(max_workers=len(searches)) as ex:
+        futures = [ex.submit(fn, *args) for fn, args in searches]
+        for fut in as_completed(futures):
+            try:
+                urls = fut.result()
+            except Exception as e:
+                print("search error", e)
+                continue
+            found += urls
+            urls = [u for u in urls if u not in TRIED_URLS]
+            random.shuffle(urls)
+            yield urls
+    if found:
+        SEARCH_CACHE[topic] = found
+        store_search_cache(topic, found)
 
 # ------------- VIDEO PROCESSING -------------
-def normalize_reencode(inp, outp):
+# H.264 encoders in order of preference; {crf} is the libx264-equivalent quality
+ENC_ARGS = {
+    "h264_nvenc": "-c:v h264_nvenc -preset p4 -rc vbr -cq {crf} -b:v 0",
+    "h264_qsv": "-c:v h264_qsv -preset veryfast -global_quality {crf}",
+    "h264_videotoolbox": "-c:v h264_videotoolbox -b:v 8M",
+    # x264 adds its own lookahead threads on top of -threads; pin them to one
+    "libx264": "-c:v libx264 -preset veryfast -threads {threads} -x264-params threads={threads}:lookahead_threads=1 -crf {crf}",
+}
+
+def detect_encoder():
+    """
+    First hardware encoder that ffmpeg both lists and can open (builds often list
+    nvenc/qsv with no device present), else libx264. VIDEO_ENCODER env overrides.
+    """
+    forced = os.environ.get("VIDEO_ENCODER","").strip()
+    if forced in ENC_ARGS: return forced
+    try:
+        listed = sh(["ffmpeg","-hide_banner","-encoders"], capture=True)
+    except Exception:
+        return "libx264"
+    for enc in ENC_ARGS:
+        if enc == "libx264" or enc not in listed: continue
+        try:
+            sh(["ffmpeg","-hide_banner","-v","error","-f","lavfi","-i","color=s=256x256:d=0.1","-c:v",enc,"-f","null","-"], capture=True)
+            return enc
+        except Exception:
+            continue
+    return "libx264"
+
+ENCODER = detect_encoder()
+
+# very_long uploads go out as HEVC when NVENC can do it: ~40% fewer bytes to upload.
+# hvc1 tagging keeps the mp4 playable by players that ignore hev1
+HEVC_ARGS = "-c:v hevc_nvenc -preset p5 -tier high -rc vbr -cq {crf} -b:v 0 -tag:v hvc1"
+
+def detect_hevc():
+    if ENCODER != "h264_nvenc": return False
+    try:
+        sh(["ffmpeg","-hide_banner","-v","error","-f","lavfi","-i","color=s=256x256:d=0.1","-c:v","hevc_nvenc","-f","null","-"], capture=True)
+        return True
+    except Exception:
+        return False
+
+HEVC_OK = detect_hevc()
+UPLOAD_VCODECS = ("h264", "hevc")
+
+# sub-60s vertical clips: B-frames and extra refs buy little size for real encode time
+SHORTS_X264_ARGS = ["-bf","0","-refs","1","-tune","fastdecode"]
+
+def venc(crf, hevc=False, shorts=False):
+    """
+    Encoder args; libx264 stays at X264_THREADS so a shared runner is never
+    oversubscribed (shorts run ENCODE_WORKERS = CPUS // X264_THREADS at a time).
+    """
+    if hevc and HEVC_OK: return HEVC_ARGS.format(crf=crf).split()
+    args = ENC_ARGS[ENCODER].format(crf=crf, threads=X264_THREADS).split()
+    if shorts and ENCODER == "libx264": args += SHORTS_X264_ARGS
+    return args
+
+def hw_input():
+    # with NVENC, decode on NVDEC and keep frames in GPU memory for the encoder
+    return ["-hwaccel","cuda","-hwaccel_output_format","cuda"] if ENCODER == "h264_nvenc" else []
+
+def encode_measured(argv, measure=True):
+    """
+    Run an ffmpeg encode whose output is argv[-1]. With measure, volumedetect runs
+    on the same decode and the level is seeded into the probe cache, so a later
+    audio_ok() on the output costs nothing. Returns mean_db (or None).
+    """
+    if not measure:
+        sh(argv); return None
+    out = sh(argv[:1] + ["-hide_banner","-nostats"] + argv[1:-1] + ["-af","volumedetect"] + argv[-1:], capture=True)
+    m = MEAN_VOL_RE.search(out)
+    if not m: return None
+    mv = float(m.group(1))
+    seed_probe(has_audio_stream, argv[-1], True)
+    seed_probe(audio_mean_db, argv[-1], mv)
+    return mv
+
+def normalize_reencode(inp, outp, hevc=False):
     try:
-        sh(f'ffmpeg -y -i "{inp}" -c:v libx264 -preset veryfast -crf 22 -c:a aac -b:a 192k -movflags +faststart "{outp}"')
+        encode_measured(["ffmpeg","-y", *hw_input(), "-i",inp, *venc(22, hevc), "-c:a","aac","-b:a","192k","-movflags","+faststart",outp], has_audio_stream(inp))
         return True
     except Exception as e:
         print("normalize_reencode error", e); return False
 
-def make_vertical(inp, outp):
+def promote_final(inp, outp):
+    """
+    Move an already h264|hevc/aac build into place (atomic os.replace on the same
+    filesystem, shutil.move across devices); anything else is normalized.
+    """
+    vcodec, acodec = stream_codecs(inp)
+    if vcodec not in UPLOAD_VCODECS or acodec not in ("aac", None):
+        return normalize_reencode(inp, outp)
     try:
-        sh(f'ffmpeg -y -i "{inp}" -vf "scale=1080:-2, pad=1080:1920:(ow-iw)/2:(oh-ih)/2" -c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 192k -movflags +faststart "{outp}"')
+        try:
+            os.replace(inp, outp)
+        except OSError as e:
+            if e.errno != errno.EXDEV: raise
+            shutil.move(inp, outp)
+        # pick_and_build already measured this file; don't let main() measure it again
+        move_probes(inp, outp)
         return True
     except Exception as e:
-        print("make_vertical error", e); return False
+        print("promote_final error", e); return False
+
+VERTICAL_VF = "scale=1080:-2,pad=1080:1920:(ow-iw)/2:(oh-ih)/2,format=yuv420p"
 
-def concat_and_reencode(list_txt, outp):
+def cuda_vertical_vf():
+    """
+    Filter chain for GPU-decoded frames. Builds with pad_cuda keep every frame in
+    VRAM; older ones scale on the GPU, pad on the CPU and upload again.
+    """
+    try:
+        if ENCODER == "h264_nvenc" and "pad_cuda" in sh(["ffmpeg","-hide_banner","-filters"], capture=True):
+            return "scale_cuda=1080:-2:format=nv12,pad_cuda=1080:1920:(ow-iw)/2:(oh-ih)/2"
+    except Exception:
+        pass
+    return "scale_cuda=1080:-2:format=nv12,hwdownload,format=nv12,pad=1080:1920:(ow-iw)/2:(oh-ih)/2,hwupload_cuda"
+
+VERTICAL_VF_CUDA = cuda_vertical_vf()
+
+def build_short(inp, outp, seconds, has_audio=True):
+    """
+    Trim, pad to 1080x1920 and encode in one pass. volumedetect runs on the same
+    decode, so the audio level comes back without re-reading the output.
+    Returns (outp or None, mean_db).
+    """
+    tail = [*venc(23, shorts=True), "-c:a","aac","-b:a","192k","-movflags","+faststart",outp]
+    if hw_input():
+        try:
+            return outp, encode_measured(["ffmpeg","-y", *hw_input(), "-i",inp,"-t",int(seconds),"-vf",VERTICAL_VF_CUDA, *tail], has_audio)
+        except Exception as e:
+            print("build_short cuda path failed, retrying with CPU filters", e)
+    try:
+        mv = encode_measured(["ffmpeg","-y","-i",inp,"-t",int(seconds),"-vf",VERTICAL_VF, *tail], has_audio)
+    except Exception as e:
+        print("build_short error", e); return None, None
+    return outp, mv
+
+def trim_clip(inp, outp, seconds):
+    """
+    First `seconds` of inp by stream copy. Falls back to a re-encode only if the
+    copy fails or comes out clearly short (no usable keyframe near the cut).
+    """
+    try:
+        sh(["ffmpeg","-y","-ss","0","-i",inp,"-t",int(seconds),"-c","copy","-avoid_negative_ts","make_zero","-movflags","+faststart",outp])
+        if ffprobe_duration(outp) >= 0.8 * int(seconds): return True
+        print("trim copy came out short; re-encoding")
+    except Exception as e:
+        print("trim copy failed", e)
+    try:
+        sh(["ffmpeg","-y","-i",inp,"-t",int(seconds), *venc(23, shorts=True), "-c:a","aac","-b:a","192k","-movflags","+faststart",outp])
+        return True
+    except Exception as e:
+        print("trim_clip error", e); return False
+
+def concat_and_reencode(list_txt, outp, hevc=False):
     try:
-        tmp = OUT / "tmp_concat.mp4"
-        sh(f'ffmpeg -y -f concat -safe 0 -i "{list_txt}" -c copy "{tmp}"')
-        return normalize_reencode(tmp, outp)
+        encode_measured(["ffmpeg","-y","-f","concat","-safe","0","-i",list_txt, *venc(22, hevc), "-c:a","aac","-b:a","192k","-movflags","+faststart",outp])
+        return True
     except Exception as e:
         print("concat_and_reencode error", e); return False
 
-def loop_to_target(src, seconds, outp):
+def loop_to_target(src, seconds, outp, hevc=False):
+    # h264|hevc/aac sources loop as a container copy; anything else is re-encoded
+    vcodec, acodec = stream_codecs(src)
+    if vcodec in UPLOAD_VCODECS and acodec in ("aac", None):
+        try:
+            sh(["ffmpeg","-y","-fflags","+genpts","-stream_loop","-1","-i",src,"-t",int(seconds),"-c","copy", *(["-tag:v","hvc1"] if vcodec == "hevc" else []),"-avoid_negative_ts","make_zero","-movflags","+faststart",outp])
+            return True
+        except Exception as e:
+            print("loop_to_target copy failed, re-encoding", e)
     try:
-        sh(f'ffmpeg -y -stream_loop -1 -i "{src}" -t {int(seconds)} -c:v libx264 -preset veryfast -crf 22 -c:a aac -b:a 192k -movflags +faststart "{outp}"')
+        encode_measured(["ffmpeg","-y", *hw_input(), "-stream_loop","-1","-i",src,"-t",int(seconds), *venc(22, hevc), "-c:a","aac","-b:a","192k","-movflags","+faststart",outp], has_audio_stream(src))
         return True
     except Exception as e:
         print("loop_to_target error", e); return False
 
+BG_CACHE_TTL = 24 * 3600
+
+def bg_cache_path(url):
+    return WORK / f"bg_cache_{hashlib.sha1(url.encode()).hexdigest()[:12]}.mp3"
+
+BG_CACHE_LOCK = threading.Lock()  # one download per track, even with overlays running side by side
+
+def cached_bg(url):
+    """Local copy of a remote bg track, downloaded once and reused for BG_CACHE_TTL."""
+    path = bg_cache_path(url)
+    with BG_CACHE_LOCK:
+        if not (path.exists() and time.time() - path.stat().st_mtime < BG_CACHE_TTL):
+            tmp = path.with_name(path.name + ".part")
+            try:
+                download_url(tmp, url)
+                os.replace(tmp, path)
+            finally:
+                tmp.unlink(missing_ok=True)
+    return path
+
 def overlay_fallback_audio(video_in, video_out):
     """
     If video_in has audio -> mix with bg audio (soft bg).
     If video_in has NO audio -> map bg audio as sole audio track.
-    Try local fallback first, then remote urls.
+    Try local fallback first, then remote urls. A remote track is downloaded once
+    into WORK and reused by later overlays; ffmpeg always reads a local (seekable)
+    file. The video stream is copied, and bg audio loops so it never cuts the
+    video short.
     """
     candidates = []
     if FALLBACK_LOCAL.exists():
@@ -233,24 +668,17 @@ def overlay_fallback_audio(video_in, video_out):
     ]
     for audio_src in candidates:
         try:
-            if Path(audio_src).exists():
-                audio_file = audio_src
-            else:
-                audio_file = OUT / "tmp_bg.mp3"
-                download_url(audio_file, audio_src)
+            audio_in = audio_src if Path(audio_src).exists() else str(cached_bg(audio_src))
+            bg = ["-stream_loop","-1","-i",audio_in]
             # If original has audio -> amix
             if has_audio_stream(video_in):
-                cmd = (
-                    f'ffmpeg -y -i "{video_in}" -i "{audio_file}" '
-                    f'-filter_complex "[0:a]volume=1[a0];[1:a]volume=0.14[a1];[a0][a1]amix=inputs=2:duration=first:dropout_transition=2[aout]" '
-                    f'-map 0:v -map "[aout]" -c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 192k -movflags +faststart "{video_out}"'
-                )
+                cmd = ["ffmpeg","-y","-i",video_in, *bg,
+                       "-filter_complex","[0:a]volume=1[a0];[1:a]volume=0.14[a1];[a0][a1]amix=inputs=2:duration=first:dropout_transition=2[aout]",
+                       "-map","0:v","-map","[aout]","-c:v","copy","-c:a","aac","-b:a","192k","-movflags","+faststart",video_out]
             else:
                 # No audio in original -> use bg audio as the audio track
-                cmd = (
-                    f'ffmpeg -y -i "{video_in}" -i "{audio_file}" -map 0:v -map 1:a '
-                    f'-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 192k -shortest -movflags +faststart "{video_out}"'
-                )
+                cmd = ["ffmpeg","-y","-i",video_in, *bg,"-map","0:v","-map","1:a",
+                       "-c:v","copy","-c:a","aac","-b:a","192k","-shortest","-movflags","+faststart",video_out]
             sh(cmd)
             if Path(video_out).exists():
                 # quick audio check
@@ -264,22 +692,76 @@ def overlay_fallback_audio(video_in, video_out):
             continue
     return False
 
-def has_long_silence(path, silence_db=-50, max_s=2.0):
-    try:
-        out = sh(f'ffmpeg -hide_banner -nostats -i "{path}" -af "silencedetect=noise={silence_db}dB:d={max_s}" -f null -', capture=True)
-        return "silence_start" in out or "silence_end" in out
-    except Exception:
-        return True
-
 # ------------- YOUTUBE UPLOAD -------------
+TOKEN = {"value": None, "exp": 0}  # cached OAuth access token and its expiry (epoch s)
+
 def get_access_token():
+    if TOKEN["value"] and time.time() < TOKEN["exp"] - 60:
+        return TOKEN["value"]
     if not (GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET and YT_REFRESH_TOKEN):
         raise Exception("Missing Google OAuth secrets.")
     data = {"client_id":GOOGLE_CLIENT_ID,"client_secret":GOOGLE_CLIENT_SECRET,"refresh_token":YT_REFRESH_TOKEN,"grant_type":"refresh_token"}
-    r = requests.post("https://oauth2.googleapis.com/token", data=data, timeout=20)
+    r = SESSION.post("https://oauth2.googleapis.com/token", data=data, timeout=20)
     if r.status_code != 200:
         print("token error", r.status_code, r.text); raise Exception("token")
-    return r.json().get("access_token")
+    j = r.json()
+    TOKEN["value"] = j.get("access_token")
+    TOKEN["exp"] = time.time() + int(j.get("expires_in", 3500))
+    return TOKEN["value"]
+
+UPLOAD_CHUNK = 8 * 1024 * 1024  # resumable protocol wants multiples of 256 KiB
+
+def upload_offset(upload_url, total):
+    """
+    Ask a resumable session how many bytes it has. Returns that offset (308), the
+    response itself if the upload is already complete (200/201), else None.
+    """
+    r = UPLOAD_SESSION.put(upload_url, headers={"Content-Range": f"bytes */{total}"}, timeout=30)
+    if r.status_code in (200, 201): return r
+    if r.status_code != 308: return None
+    rng = r.headers.get("Range")
+    return int(rng.rsplit("-", 1)[1]) + 1 if rng else 0
+
+def upload_chunks(upload_url, file_path, chunk_size=UPLOAD_CHUNK, max_retries=5):
+    """
+    PUT file_path to a resumable upload session in chunk_size pieces. 308 means
+    "send more" and its Range header says from where; a dropped connection or 5xx
+    resumes from the server's offset instead of restarting the file. Returns the last response.
+    """
+    total = os.path.getsize(file_path)
+    sent, retries = 0, 0
+    with open(file_path, "rb") as f:
+        while True:
+            f.seek(sent)
+            chunk = f.read(chunk_size)
+            headers = {"Content-Type":"application/octet-stream", "Content-Range": f"bytes {sent}-{sent+len(chunk)-1}/{total}"}
+            try:
+                up = UPLOAD_SESSION.put(upload_url, data=chunk, headers=headers, timeout=600)
+                err = f"HTTP {up.status_code}" if up.status_code >= 500 else None
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                up, err = None, e
+            if err:
+                # transient: back off exponentially, then resume from the server's confirmed offset
+                retries += 1
+                if retries > max_retries:
+                    if up is not None: return up
+                    raise err
+                print(f"upload chunk at {sent}/{total} failed ({err}); retry {retries}")
+                time.sleep(min(60, 2 ** retries))
+                try:
+                    offset = upload_offset(upload_url, total)
+                    # the lost response was the final one: the video is in, don't resend
+                    if isinstance(offset, requests.Response): return offset
+                    if offset is not None: sent = offset
+                except Exception as qe:
+                    print("upload status query failed", qe)
+                continue
+            if up.status_code == 308:
+                rng = up.headers.get("Range")
+                sent = int(rng.rsplit("-", 1)[1]) + 1 if rng else 0
+                retries = 0
+                continue
+            return up
 
 def upload_to_youtube(file_path, title, description, tags, privacy="public", max_attempts=3):
     for attempt in range(1, max_attempts+1):
@@ -287,7 +769,7 @@ def upload_to_youtube(file_path, title, description, tags, privacy="public", max
             token = get_access_token()
             meta = {"snippet":{"title":title,"description":description,"tags":tags,"categoryId":"22"},"status":{"privacyStatus":privacy}}
             headers = {"Authorization":f"Bearer {token}", "Content-Type":"application/json; charset=UTF-8"}
-            resp = requests.post("https://www.googleapis.com/upload/youtube/v3/videos?uploadType=resumable&part=snippet,status",
+            resp = SESSION.post("https://www.googleapis.com/upload/youtube/v3/videos?uploadType=resumable&part=snippet,status",
                                  headers=headers, data=json.dumps(meta), timeout=30, allow_redirects=False)
             if resp.status_code == 403:
                 try:
@@ -303,8 +785,7 @@ def upload_to_youtube(file_path, title, description, tags, privacy="public", max
             upload_url = resp.headers.get("Location") or resp.headers.get("location")
             if not upload_url:
                 print("no upload url", resp.status_code, resp.text); raise Exception("no_url")
-            with open(file_path,"rb") as f:
-                up = requests.put(upload_url, data=f, headers={"Content-Type":"application/octet-stream"}, timeout=3600)
+            up = upload_chunks(upload_url, file_path)
             if up.status_code not in (200,201):
                 print("upload status", up.status_code, up.text)
                 if up.status_code == 403 and "quotaExceeded" in (up.text or ""):
@@ -327,15 +808,9 @@ def upload_to_youtube(file_path, title, description, tags, privacy="public", max
 # ------------- METADATA -------------
 def choose_title_desc(vtype, dur_seconds, topic):
     topic_clean = topic.title() if topic else "Relaxing"
-    emoji_map={"Rain":"🌧️","Ocean":"🌊","Forest":"🌿","Waterfall":"💧","Snow":"❄️","Clouds":"☁️","Underwater Diving":"🤿","Birds":"🐦"}
-    emoji = emoji_map.get(topic_clean, "🌿")
-    if vtype == "shorts":
-        template = random.choice(TITLE_TEMPLATES["shorts"])
-        title = f"{emoji} {template.format(topic_clean)}"
-    elif vtype == "long":
-        title = f"{emoji} {random.choice(TITLE_TEMPLATES['long']).format(topic_clean)}"
-    else:
-        title = f"{emoji} {random.choice(TITLE_TEMPLATES['very_long']).format(topic_clean)}"
+    emoji = TITLE_EMOJI.get(topic_clean, "🌿")
+    templates = TITLE_TEMPLATES.get(vtype) or TITLE_TEMPLATES["very_long"]
+    title = f"{emoji} {random.choice(templates).format(topic_clean)}"
     hashtags = "#relaxing #nature #sleep #meditation #calm"
     minutes = max(1, int(math.ceil(dur_seconds / 60.0)))
     desc = "\n".join([
@@ -347,133 +822,246 @@ def choose_title_desc(vtype, dur_seconds, topic):
         "",
         hashtags
     ])
-    tags = TAGS_BASE + [topic.lower() if topic else "relaxing"]
+    tags = list(TAGS_BASE)
+    tags.append(topic.lower() if topic else "relaxing")
     if vtype == "shorts": tags.append("shorts")
     return title, desc, list(dict.fromkeys(tags))[:20]
 
 # ------------- BUILD FLOW -------------
+def fetch_clip(i, url, mirrors=None):
+    TRIED_URLS.add(url)
+    p = CLIPS / f"clip_{i}.mp4"  # i is "<attempt id>_<queue index>", unique across the run
+    size = preflight_clip(url)
+    if size and mirrors is not None:
+        # same file mirrored under another url: same size (MiB bucket) and file name.
+        # dict.setdefault is atomic, so concurrent workers need no extra lock
+        key = (size >> 20, Path(urlsplit(url).path).name)
+        if mirrors.setdefault(key, url) != url:
+            raise ValueError(f"skip {url}: duplicate of {mirrors[key]}")
+    # mp4 does not compress further; ask for the raw bytes so nothing is inflated in Python
+    download_url(p, url, headers={"Accept-Encoding":"identity"})
+    info = probe_clip(p)
+    print("Downloaded", p, "dur=", info["duration"], "audio=", info["has_audio"], "mv=", info["mean_db"], "silence=", info["has_silence"])
+    return p, info["duration"], info["has_audio"], info["mean_db"], info["has_silence"]
+
+def collect_clips(topic, tag):
+    """
+    Search -> download/probe pipeline. Searchers feed url_q as each returns,
+    DOWNLOAD_WORKERS threads download + probe into result_q, and this thread
+    returns as soon as MAX_DOWNLOADS usable clips are in hand. Nothing is joined:
+    the feeder finishes caching the topic's search results in the background,
+    and clips that land after the return are deleted. Clips are named
+    clip_<tag>_<n>.mp4; unusable ones are deleted.
+    """
+    url_q, result_q = queue.Queue(), queue.Queue()
+    stop = threading.Event()
+    handoff = threading.Lock()  # a clip is either queued before stop or deleted after it
+    mirrors = {}  # (size bucket, file name) -> url, filled by preflight in fetch_clip
+
+    def feed():
+        try:
+            n, queued = 0, set()  # (host, path) already handed to the workers
+            # drain every batch (even once stopped) so the topic still gets cached
+            for urls in candidate_batches(topic):
+                for url in urls:
+                    if n >= MAX_CANDIDATES or stop.is_set(): break
+                    # same file via another searcher / query string -> download once
+                    parts = urlsplit(url)
+                    key = (parts.netloc.lower(), parts.path)
+                    if key in queued: continue
+                    queued.add(key)
+                    url_q.put((f"{tag}_{n}", url)); n += 1
+        finally:
+            for _ in range(DOWNLOAD_WORKERS): url_q.put(None)
+
+    def fetch():
+        while not stop.is_set():
+            item = url_q.get()
+            if item is None: break
+            try:
+                clip = fetch_clip(*item, mirrors)
+            except Exception as e:
+                print("download failed", e); continue
+            with handoff:
+                if stop.is_set(): Path(clip[0]).unlink(missing_ok=True)
+                else: result_q.put(clip)
+        result_q.put(None)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads += [threading.Thread(target=fetch, daemon=True) for _ in range(DOWNLOAD_WORKERS)]
+    for t in threads: t.start()
+    downloaded, running = [], DOWNLOAD_WORKERS
+    def take(clip):
+        if clip[1] > 0: downloaded.append(clip)
+        else: Path(clip[0]).unlink(missing_ok=True)
+    while running and len(downloaded) < MAX_DOWNLOADS:
+        clip = result_q.get()
+        if clip is None:
+            running -= 1
+        else:
+            take(clip)
+    with handoff:
+        stop.set()
+        # anything queued past MAX_DOWNLOADS is surplus
+        while not result_q.empty():
+            clip = result_q.get()
+            if clip is not None: Path(clip[0]).unlink(missing_ok=True)
+    return downloaded
+
+def pool_seconds(clips):
+    return sum(int(min(c[1], 300)) for c in clips)
+
+def pool_topic(clips):
+    """Topic that contributes the most seconds to clips."""
+    secs = {}
+    for c in clips: secs[c[5]] = secs.get(c[5], 0) + min(c[1], 300)
+    return max(secs, key=secs.get)
+
+def trim_pool(clips, max_bytes=MAX_POOL_BYTES):
+    """Evict (and delete) the shortest pooled clips until the pool fits in max_bytes."""
+    size = sum(c[0].stat().st_size for c in clips if c[0].exists())
+    while len(clips) > 1 and size > max_bytes:
+        c = min(clips, key=itemgetter(1))
+        clips.remove(c)
+        if c[0].exists():
+            size -= c[0].stat().st_size
+            c[0].unlink()
+
 def pick_and_build(vtype, min_s, max_s):
     ensure_dirs()
+    # every topic once (in random order) before any repeats
+    topics = random.sample(TOPICS, len(TOPICS)) * (TRY_COUNT // len(TOPICS) + 1)
     tries = 0
+    reset_dir(CLIPS)
+    # long builds keep their usable clips (tagged with their topic) across attempts
+    candidates_audio, singles_tried = [], set()
     while tries < TRY_COUNT:
+        topic = topics[tries]
         tries += 1
-        topic = random.choice(TOPICS)
+        # one id per attempt: time-based names collided within the same second
+        attempt_id = f"{tries}_{os.urandom(3).hex()}"
+        # drop intermediates left over from the previous attempt
+        reset_dir(OUT)
         print(f"[search] Attempt {tries} — topic: {topic}")
-        cand_urls = gather_candidates(topic)
-        if not cand_urls:
-            print("No candidates found; retry")
-            time.sleep(1)
-            continue
-
-        # download up to 8
-        downloaded = []
-        for i, url in enumerate(cand_urls[:8]):
-            try:
-                p = CLIPS / f"clip_{int(time.time())}_{i}.mp4"
-                download_url(p, url)
-                dur = ffprobe_duration(p)
-                aud = has_audio_stream(p)
-                mv = audio_mean_db(p) if aud else None
-                print("Downloaded", p, "dur=", dur, "audio=", aud, "mv=", mv)
-                if dur > 0:
-                    downloaded.append((p, dur, aud, mv))
-            except Exception as e:
-                print("download failed", e)
-                continue
-
-        if not downloaded:
+        # a long pool that already covers min_s is built from before downloading more
+        enough = vtype != "shorts" and pool_seconds(candidates_audio) >= min_s
+        downloaded = [] if enough else collect_clips(topic, attempt_id)
+        if not downloaded and not candidates_audio:
             print("No downloaded clips — retry")
             time.sleep(1)
             continue
 
         # SHORTS
         if vtype == "shorts":
-            for p,dur,aud,mv in sorted(downloaded, key=lambda x: -x[1]):
-                if dur < 4 or dur > SHORT_MAX_S: continue
-                candidate = OUT / f"short_candidate_{int(time.time())}.mp4"
-                ok_vert = make_vertical(str(p), str(candidate))
-                if not ok_vert:
-                    try:
-                        sh(f'ffmpeg -y -i "{p}" -t {int(min(dur, SHORT_MAX_S))} -c copy "{candidate}"')
-                    except Exception:
+            eligible = [c for c in sorted(downloaded, key=itemgetter(1), reverse=True) if 4 <= c[1] <= SHORT_MAX_S]
+            outs = [OUT / f"short_{attempt_id}_{c[0].stem}.mp4" for c in eligible]
+            ex = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+            builds = {}
+            try:
+                for n, (p,dur,aud,mv,sil) in enumerate(eligible):
+                    # keep up to ENCODE_WORKERS shorts encoding ahead of the one being checked
+                    for k in range(n, min(n + ENCODE_WORKERS, len(eligible))):
+                        if k not in builds:
+                            c = eligible[k]
+                            builds[k] = ex.submit(run_tagged, attempt_id, build_short, str(c[0]), str(outs[k]), min(c[1], SHORT_MAX_S), c[2])
+                    candidate = outs[n]
+                    built, mv = builds.pop(n).result()
+                    if not built and not trim_clip(p, candidate, min(dur, SHORT_MAX_S)):
                         continue
-                # ensure file exists
-                if not candidate.exists():
-                    continue
-                # if audio ok -> proceed
-                final_with_audio = OUT / f"short_audio_{int(time.time())}.mp4"
-                if audio_ok(candidate):
-                    # we can normalize
-                    reencoded = OUT / f"short_re_{int(time.time())}.mp4"
-                    if normalize_reencode(candidate, reencoded):
-                        return reencoded, topic
-                    else:
+                    # ensure file exists
+                    if not candidate.exists():
                         continue
-                else:
+                    # level measured during the encode; only re-measure the copy fallback
+                    if (mv is not None and mv > AUDIO_MIN_DB) or (mv is None and audio_ok(candidate)):
+                        return candidate, topic, dur
                     # overlay fallback audio
+                    final_with_audio = OUT / f"short_audio_{attempt_id}_{p.stem}.mp4"
                     if overlay_fallback_audio(str(candidate), str(final_with_audio)):
                         if audio_ok(final_with_audio):
-                            reencoded = OUT / f"short_re_{int(time.time())}.mp4"
-                            if normalize_reencode(final_with_audio, reencoded):
-                                return reencoded, topic
-                            else:
-                                continue
-                        else:
-                            print("Overlay produced file but audio not OK; try next candidate")
-                            continue
-                    else:
-                        print("Overlay failed for this candidate; try next")
+                            return final_with_audio, topic, dur
+                        print("Overlay produced file but audio not OK; try next candidate")
                         continue
+                    print("Overlay failed for this candidate; try next")
+            finally:
+                # speculative encodes still running are discarded: kill them rather than wait
+                cancel_group(attempt_id)
+                ex.shutdown(wait=True, cancel_futures=True)
+            # every clip of this attempt was tried (or is the wrong length)
+            for c in downloaded: c[0].unlink(missing_ok=True)
             print("No suitable short found — retry")
             time.sleep(1)
             continue
 
         # LONG / VERY_LONG
-        candidates_audio = [t for t in downloaded if t[2] and (t[3] is None or t[3] > AUDIO_MIN_DB)]
+        hevc = vtype == "very_long"
+        for t in downloaded:
+            if t[2] and (t[3] is None or t[3] > AUDIO_MIN_DB): candidates_audio.append((*t, topic))
+            else: t[0].unlink(missing_ok=True)
+        trim_pool(candidates_audio)
         # try single clip
-        for p,dur,aud,mv in sorted(candidates_audio, key=lambda x: -x[1]):
-            if dur >= min_s and dur <= max_s and not has_long_silence(p):
-                final = OUT / f"long_single_{int(time.time())}.mp4"
-                if normalize_reencode(p, final) and audio_ok(final):
-                    return final, topic
+        for p,dur,aud,mv,sil,src_topic in sorted(candidates_audio, key=itemgetter(1), reverse=True):
+            if dur >= min_s and dur <= max_s and not sil and p not in singles_tried:
+                singles_tried.add(p)
+                final = OUT / f"long_single_{attempt_id}_{p.stem}.mp4"
+                if normalize_reencode(p, final, hevc) and audio_ok(final):
+                    return final, src_topic, dur
         # concat until min_s
         listfile = OUT / "list.txt"
-        if listfile.exists(): listfile.unlink()
-        total = 0; idx = 0
-        for p,dur,aud,mv in candidates_audio:
-            trim = int(min(dur, 300))
-            outtrim = OUT / f"trim_{int(time.time())}_{idx}.mp4"
-            try:
-                sh(f'ffmpeg -y -i "{p}" -t {trim} -c copy "{outtrim}"')
-                with open(listfile, "a") as f:
-                    f.write(f"file '{outtrim.resolve()}'\n")
-                total += trim; idx += 1
-            except Exception as e:
-                print("trim failed", e); continue
+        # each clip is cut by an outpoint directive, so the single concat encode does the trimming
+        total = 0; entries = []; used = []
+        for c in candidates_audio:
+            trim = int(min(c[1], 300))
+            entries.append(f"file '{Path(c[0]).resolve()}'\noutpoint {trim}\n")
+            used.append(c)
+            total += trim
             if total >= min_s: break
         if total >= min_s:
-            combined = OUT / f"combined_{int(time.time())}.mp4"
-            if concat_and_reencode(listfile, combined):
+            listfile.write_text("".join(entries))
+            combined = OUT / f"combined_{attempt_id}.mp4"
+            if concat_and_reencode(listfile, combined, hevc):
                 if audio_ok(combined):
-                    return combined, topic
-                if overlay_fallback_audio(str(combined), str(OUT / f"withbg_{int(time.time())}.mp4")):
-                    candf = OUT / f"withbg_{int(time.time())}.mp4"
+                    return combined, pool_topic(used), total
+                candf = OUT / f"withbg_{attempt_id}.mp4"
+                if overlay_fallback_audio(str(combined), str(candf)):
                     if audio_ok(candf):
-                        return candf, topic
+                        return candf, pool_topic(used), total
 
-        # fallback: loop first audio clip
-        if candidates_audio:
-            first = candidates_audio[0][0]
-            outloop = OUT / f"loop_{int(time.time())}.mp4"
-            if loop_to_target(first, min_s, outloop) and audio_ok(outloop):
-                return outloop, topic
+        # fallback: loop first audio clip, once the concat failed or no attempts are left to add clips
+        if candidates_audio and (total >= min_s or tries == TRY_COUNT):
+            first = candidates_audio[0]
+            outloop = OUT / f"loop_{attempt_id}.mp4"
+            if loop_to_target(first[0], min_s, outloop, hevc) and audio_ok(outloop):
+                return outloop, first[5], min_s
+        if total >= min_s:
+            # these clips just failed to build; drop them so the next attempt tries a different list
+            for c in used:
+                candidates_audio.remove(c)
+                c[0].unlink(missing_ok=True)
 
-        print("Build attempt failed — retry")
+        print(f"Build attempt failed ({total}s of {min_s}s collected) — retry")
         time.sleep(1)
 
-    return None, None
+    return None, None, 0
 
 # ------------- MAIN -------------
+UPLOAD_LOG_HEADER = ("time", "type", "video_id", "title")
+
+def log_upload(vtype, vid, title):
+    """
+    Append one row to UPLOAD_LOG (header on first write). csv quoting keeps
+    titles with commas intact; fsync so the row survives an abrupt exit.
+    """
+    try:
+        new = not UPLOAD_LOG.exists() or UPLOAD_LOG.stat().st_size == 0
+        with open(UPLOAD_LOG, "a", newline="", encoding="utf-8") as f:
+            w = csv.writer(f)
+            if new: w.writerow(UPLOAD_LOG_HEADER)
+            w.writerow((time.strftime("%Y-%m-%d %H:%M:%S"), vtype, vid, title))
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        print("upload log write failed", e)
+
 def main():
     if len(sys.argv) < 3 or sys.argv[1] != "--type":
         print("Usage: python3 main.py --type shorts|long|very_long"); sys.exit(1)
@@ -490,22 +1078,24 @@ def main():
         print("Unknown type"); sys.exit(1)
 
     ensure_dirs()
+    prefetch_dns()
     tries = 0
     while tries < TRY_COUNT:
         tries += 1
         print(f"[main] Attempt {tries}/{TRY_COUNT} for type={vtype}")
-        final_file, topic = pick_and_build(vtype, min_s, max_s)
+        final_file, topic, dur = pick_and_build(vtype, min_s, max_s)
         if not final_file:
             print("No final produced; retry"); continue
-        safe = OUT / f"final_safe_{int(time.time())}.mp4"
-        if not normalize_reencode(final_file, safe):
-            print("Final reencode failed; retry"); continue
-        dur = ffprobe_duration(safe)
+        run_id = f"{tries}_{os.urandom(3).hex()}"
+        safe = OUT / f"final_safe_{run_id}.mp4"
+        if not promote_final(final_file, safe):
+            print("Final promotion failed; retry"); continue
         if not audio_ok(safe):
             print("Final audio not OK, try overlay fallback")
-            if not overlay_fallback_audio(str(safe), str(OUT / f"final_with_bg_{int(time.time())}.mp4")):
+            with_bg = OUT / f"final_with_bg_{run_id}.mp4"
+            if not overlay_fallback_audio(str(safe), str(with_bg)):
                 print("Overlay fallback failed; retry"); continue
-            safe = OUT / f"final_with_bg_{int(time.time())}.mp4"
+            safe = with_bg
             if not audio_ok(safe): print("Audio still bad; retry"); continue
         title, desc, tags = choose_title_desc(vtype, dur, topic or "relaxing")
         print("Uploading:", safe, "title:", title)
@@ -513,8 +1103,7 @@ def main():
             vid = upload_to_youtube(str(safe), title, desc, tags, privacy="public", max_attempts=3)
             url = f"https://youtu.be/{vid}" if vid else "no-id"
             print("[DONE] Uploaded:", url)
-            with open(UPLOAD_LOG, "a") as f:
-                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')},{vtype},{vid},{title}\n")
+            log_upload(vtype, vid, title)
             return
         except Exception as e:
             print("Upload failed:", e)